@@ -1,11 +1,24 @@
+import asyncio
+import binascii
 import subprocess
 import tempfile
 import os
+import hashlib
+import json
+import mmap
+import re
+import shutil
+import signal
+import weakref
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import List, Optional, Dict, Any
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Request
-from fastapi.responses import Response
-from pydantic import BaseModel, Extra
+from typing import List, Optional, Dict, Set, Any, Tuple, Union, AnyStr, Literal, Callable
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Request, Header
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, Extra, ValidationError
 from fastapi.middleware.cors import CORSMiddleware
 import logging
 
@@ -31,6 +44,139 @@ ALLOWED_EXTENSIONS = {
     '.lua', '.py', '.r',  # Script files (for dynamic content)
 }
 
+# latexmk configuration files, which latexmk would execute as Perl
+LATEXMK_RC_NAMES = frozenset({'latexmkrc', '.latexmkrc'})
+
+# Formats whose content arrives base64 encoded
+IMAGE_FORMATS = frozenset({'png', 'jpg', 'jpeg', 'gif', 'pdf', 'eps'})
+
+# Conventional main file names, mapped to their priority (lower wins)
+MAIN_FILE_NAMES = {
+    name: rank for rank, name in enumerate(['main.tex', 'document.tex', 'paper.tex', 'thesis.tex'])
+}
+
+# Source features that select a compiler, matched in one pass by choose_compiler
+COMPILER_FEATURE_RE = re.compile(
+    rb'\\(?:usepackage\{(?:(?P<xelatex>fontspec|xltxtra|xunicode|polyglossia)'
+    rb'|(?P<lualatex>luacode|luatextra|luamplib))\}'
+    rb'|(?P<font>set(?:main|sans|mono)font))'
+)
+
+# Commands rejected by validate_tex_file
+DANGEROUS_COMMANDS = [
+    '\\write18',  # Shell escape
+    '\\immediate\\write18',  # Shell escape
+    '\\input{|',  # Pipe input
+    '\\openin',   # File operations
+    '\\openout',  # File operations
+]
+DANGEROUS_COMMAND_RE = re.compile(b'|'.join(re.escape(cmd.encode()) for cmd in DANGEROUS_COMMANDS))
+
+# Memoized results of choose_compiler/validate_tex_file, keyed by source digest
+SCAN_CACHE_MAX_ENTRIES = 512
+COMPILER_SCAN_CACHE: "OrderedDict[bytes, str]" = OrderedDict()
+VALIDATION_SCAN_CACHE: "OrderedDict[bytes, Optional[str]]" = OrderedDict()
+
+# Preamble formats: pdflatex preambles dumped with mylatexformat so later
+# compiles of the same preamble skip loading the document class and packages
+PREAMBLE_FORMATS_ENABLED = os.getenv("LATEX_PREAMBLE_FORMATS", "1") != "0"
+FORMAT_CACHE_MAX_ENTRIES = int(os.getenv("LATEX_FORMAT_CACHE_MAX_ENTRIES", "32"))
+PREAMBLE_END_RE = re.compile(rb'^[^%\n]*\\begin\{document\}', re.MULTILINE)
+# Preambles that open output files, which a dumped format cannot keep open
+PREAMBLE_FORMAT_BLOCKERS_RE = re.compile(rb'\\(?:makeindex|makeglossaries)\b')
+
+def get_scratch_dir() -> Optional[str]:
+    """
+    Pick the directory that holds per-compile temporary directories.
+    
+    Prefers LATEX_SCRATCH_DIR, then a tmpfs under /dev/shm so LaTeX's many
+    small intermediate files never touch the disk.
+    
+    Returns:
+        Directory path, or None to use the system default temp directory
+    """
+    scratch_dir = os.getenv("LATEX_SCRATCH_DIR") or ("/dev/shm/latex-compile" if os.path.isdir("/dev/shm") else "")
+    if not scratch_dir:
+        return None
+    
+    try:
+        os.makedirs(scratch_dir, exist_ok=True)
+    except OSError as e:
+        logger.warning(f"Scratch directory {scratch_dir} unavailable, using default temp directory: {e}")
+        return None
+    
+    return scratch_dir if os.access(scratch_dir, os.W_OK) else None
+
+SCRATCH_DIR = get_scratch_dir()
+
+# Amount of a failed pass's .log transcript, and of each captured tool output, included in the response
+LOG_TAIL_BYTES = 16384
+
+# Buffer size for writing project files
+WRITE_BUFFER_SIZE = 1 << 20
+
+# Characters of base64 content decoded at a time; a multiple of 4
+BASE64_CHUNK_CHARS = 1 << 16
+
+# On-disk cache of compiled PDFs, keyed by a hash of the compilation inputs
+CACHE_DIR = Path(os.getenv("LATEX_CACHE_DIR", os.path.join(tempfile.gettempdir(), "latex-cache")))
+CACHE_MAX_ENTRIES = int(os.getenv("LATEX_CACHE_MAX_ENTRIES", "256"))
+FORMAT_CACHE_DIR = CACHE_DIR / "formats"
+
+# Persistent per-project working directories, so .aux/.bbl/.toc files carry over between compiles;
+# kept on the scratch tmpfs with the per-compile directories
+WORK_ROOT = Path(os.getenv("LATEX_WORK_ROOT") or os.path.join(SCRATCH_DIR or tempfile.gettempdir(), "latex-projects"))
+WORK_ROOT_MAX_ENTRIES = int(os.getenv("LATEX_WORK_ROOT_MAX_ENTRIES", "64"))
+# Bound on their total size, leaving room on the tmpfs for the per-compile directories
+WORK_ROOT_MAX_BYTES = int(os.getenv("LATEX_WORK_ROOT_MAX_BYTES", str(256 << 20)))
+
+# Digests of the project files last written to a working directory
+MANIFEST_NAME = ".manifest.json"
+
+# Serializes compiles sharing a working directory; entries vanish once no request holds them
+PROJECT_LOCKS: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+# Version banners of the installed compilers, filled on first use
+COMPILER_VERSIONS: Dict[str, str] = {}
+
+# Compilers found on this host, probed once at startup
+SUPPORTED_COMPILERS = ['pdflatex', 'xelatex', 'lualatex']
+AVAILABLE_COMPILERS: List[str] = []
+
+# Seconds allowed for one LaTeX pass and for one bibliography tool run
+COMPILE_PASS_TIMEOUT = 120
+BIBLIOGRAPHY_TIMEOUT = 30
+
+# Seconds allowed for a whole latexmk run; defaults to the worst case of the
+# manual passes (three LaTeX passes plus biber and bibtex)
+LATEXMK_TIMEOUT = int(os.getenv("LATEX_LATEXMK_TIMEOUT", str(3 * COMPILE_PASS_TIMEOUT + 2 * BIBLIOGRAPHY_TIMEOUT)))
+
+# Messages LaTeX writes to the .log when another pass is needed
+RERUN_MARKERS = (b"Rerun to get", b"Label(s) may have changed")
+
+# Auxiliary files read back on the next pass that LaTeX does not check for changes itself
+LISTING_EXTENSIONS = ('.toc', '.lof', '.lot')
+
+# Files LaTeX and its tools write next to a .tex source, kept in a reused working directory
+GENERATED_EXTENSIONS = LISTING_EXTENSIONS + (
+    '.aux', '.log', '.out', '.pdf', '.bbl', '.blg', '.bcf', '.run.xml', '.idx', '.ind', '.ilg',
+    '.glo', '.gls', '.glg', '.ist', '.nav', '.snm', '.vrb', '.fls', '.fdb_latexmk', '.synctex.gz',
+)
+
+# Per-compiler flag that runs a pass without writing the PDF
+DRAFT_MODE_FLAGS = {
+    'pdflatex': '-draftmode',
+    'lualatex': '-draftmode',
+    'xelatex': '-no-pdf',
+}
+
+# latexmk option selecting each compiler
+LATEXMK_ENGINE_FLAGS = {
+    'pdflatex': '-pdf',
+    'xelatex': '-xelatex',
+    'lualatex': '-lualatex',
+}
+
 class FileInfo(BaseModel):
     id: str
     folder_id: Optional[str] = None  # Make folder_id optional since it might not be provided
@@ -67,237 +213,1189 @@ class CompileRequest(BaseModel):
     project_data: PaperFolderData
     main_file: Optional[str] = None  # Optional main file name
 
-def is_safe_path(path: str) -> bool:
+def parse_compile_request(body: bytes) -> CompileRequest:
+    """
+    Validate a raw JSON body as a CompileRequest in a single pass.
+    
+    validate_json parses and validates in pydantic-core, instead of building
+    Python dicts with json.loads first and validating those, which matters
+    for projects carrying megabytes of file content.
+    
+    Args:
+        body: Raw request body
+        
+    Returns:
+        The validated request
+        
+    Raises:
+        RequestValidationError: If the body is not a valid CompileRequest
+    """
+    try:
+        return CompileRequest.model_validate_json(body)
+    except ValidationError as e:
+        # Report errors the way FastAPI does for declared body parameters
+        raise RequestValidationError([
+            {**error, 'loc': ('body', *error['loc'])} for error in e.errors(include_url=False)
+        ])
+
+def openapi_schema() -> Dict[str, Any]:
+    """Generate the OpenAPI schema, adding the request body models validated by parse_compile_request."""
+    if app.openapi_schema is None:
+        schema = FastAPI.openapi(app)
+        definitions = CompileRequest.model_json_schema(ref_template="#/components/schemas/{model}")
+        schemas = schema.setdefault("components", {}).setdefault("schemas", {})
+        schemas.update(definitions.pop("$defs", {}))
+        schemas["CompileRequest"] = definitions
+    return app.openapi_schema
+
+app.openapi = openapi_schema
+
+def is_safe_path(path: str) -> bool:
+    """
+    Check if a file path is safe (no directory traversal attacks).
+    
+    Args:
+        path: File path to validate
+        
+    Returns:
+        True if path is safe, False otherwise
+    """
+    # Normalize the path
+    normalized = os.path.normpath(path)
+    
+    # Check for directory traversal attempts
+    if normalized.startswith('..') or '/../' in normalized or normalized.startswith('/'):
+        return False
+    
+    return True
+
+def file_extension(name: str) -> str:
+    """
+    Get the lowercased extension of a file name without building a Path.
+    
+    Args:
+        name: File name, possibly with folder components
+        
+    Returns:
+        Extension including the dot, following Path.suffix rules ("" if none)
+    """
+    base_name = name.rstrip('/').rpartition('/')[2]
+    dot = base_name.rfind('.')
+    # Like Path.suffix: ignore a leading dot (hidden files) and a trailing one
+    if 0 < dot < len(base_name) - 1:
+        return base_name[dot:].lower()
+    return ''
+
+@dataclass
+class FlatProject:
+    """Project files flattened into parallel lists, in folder tree order."""
+    ids: List[str] = field(default_factory=list)
+    names: List[str] = field(default_factory=list)
+    formats: List[str] = field(default_factory=list)  # Lowercased file formats
+    contents: List[str] = field(default_factory=list)
+    paths: List[Path] = field(default_factory=list)
+    folders: List[Path] = field(default_factory=list)  # Folders to create, parents first
+    bib_indices: List[int] = field(default_factory=list)
+    tex_indices: List[int] = field(default_factory=list)  # Candidates for the main file
+    base_path: Optional[Path] = None
+
+def flatten_project(folder_data: PaperFolderData, base_path: Path) -> FlatProject:
+    """
+    Flatten the project folder tree in a single iterative traversal.
+    
+    Unsafe paths and unsupported extensions are dropped here, so every
+    later step works on the same pre-filtered lists.
+    
+    Args:
+        folder_data: The root folder data structure
+        base_path: Base directory path
+        
+    Returns:
+        FlatProject describing every file to write
+    """
+    project = FlatProject(base_path=base_path)
+    stack = deque([(folder_data, base_path)])
+    
+    while stack:
+        folder, current_path = stack.pop()
+        
+        # Create current folder if not root
+        if not folder.is_root:
+            current_path = current_path / folder.name
+            project.folders.append(current_path)
+        
+        if folder.files:
+            for file_info in folder.files:
+                if not is_safe_path(file_info.name):
+                    logger.warning(f"Skipping unsafe file path: {file_info.name}")
+                    continue
+                
+                if file_info.name.rpartition('/')[2] in LATEXMK_RC_NAMES:
+                    logger.warning(f"Skipping latexmk configuration file: {file_info.name}")
+                    continue
+                
+                # Validate file extension
+                file_ext = file_extension(file_info.name)
+                if file_ext and file_ext not in ALLOWED_EXTENSIONS:
+                    logger.warning(f"Skipping file with unsupported extension: {file_info.name}")
+                    continue
+                
+                if file_ext == '.bib':
+                    project.bib_indices.append(len(project.ids))
+                if file_info.format.lower() == 'tex':
+                    project.tex_indices.append(len(project.ids))
+                project.ids.append(file_info.id)
+                project.names.append(file_info.name)
+                project.formats.append(file_info.format.lower())
+                project.contents.append(file_info.content)
+                project.paths.append(current_path / file_info.name)
+        
+        # Push subfolders in reverse so they are visited in their original order
+        if folder.subfolders:
+            for subfolder in reversed(folder.subfolders):
+                stack.append((subfolder, current_path))
+    
+    return project
+
+async def create_project_structure(project: FlatProject, manifest: Optional[Dict[str, str]] = None) -> Dict[str, Path]:
+    """
+    Create the project folder structure and files.
+    
+    Files are written concurrently in worker threads so the event loop
+    stays responsive while large projects are materialized.
+    
+    Args:
+        project: The flattened project
+        manifest: Digests of the files already in the project directory, by
+            relative path. Unchanged files are left alone and everything else
+            in the directory is deleted (see remove_stale_files). Updated in
+            place to match the new files.
+        
+    Returns:
+        Dictionary mapping file IDs to their paths
+    """
+    previous = dict(manifest) if manifest else {}
+    relative_paths = [file_path.relative_to(project.base_path).as_posix() for file_path in project.paths]
+    
+    for folder_path in project.folders:
+        folder_path.mkdir(exist_ok=True)
+    
+    # Files sharing a path are written once, with the content listed last
+    last_indices = {relative_path: i for i, relative_path in enumerate(relative_paths)}
+    results = await asyncio.gather(*(
+        asyncio.to_thread(
+            materialize_file, project.paths[i], project.formats[i], project.contents[i], previous.get(relative_path)
+        )
+        for relative_path, i in last_indices.items()
+    ), return_exceptions=True)
+    results_by_path = dict(zip(last_indices, results))
+    
+    file_paths = {}
+    if manifest is not None:
+        manifest.clear()
+    
+    for file_id, name, file_path, relative_path in zip(project.ids, project.names, project.paths, relative_paths):
+        result = results_by_path[relative_path]
+        if isinstance(result, Exception):
+            logger.error(f"Error creating file {name}: {result}")
+            continue
+        
+        content_digest, written = result
+        if manifest is not None:
+            manifest[relative_path] = content_digest
+        file_paths[file_id] = file_path
+        if written:
+            logger.info(f"Created file: {file_path}")
+    
+    if manifest is not None:
+        # Remove files dropped from the project and outputs no source of this project produced
+        tex_paths = [relative_paths[i] for i in project.tex_indices]
+        folders = {folder_path.relative_to(project.base_path).as_posix() for folder_path in project.folders}
+        await asyncio.to_thread(remove_stale_files, project.base_path, manifest, tex_paths, folders)
+    
+    return file_paths
+
+def remove_stale_files(project_dir: Path, manifest: Dict[str, str], tex_paths: List[str], folders: Set[str]) -> None:
+    """
+    Delete everything in a reused working directory that the current project does not account for.
+    
+    Only the project files, the manifest, preamble formats and the files
+    LaTeX writes next to the project's own .tex sources are kept, so outputs
+    of files that are no longer in the project can never be read back.
+    
+    Args:
+        project_dir: Persistent project working directory
+        manifest: Digests of the project files, by relative path
+        tex_paths: Relative paths of the project's .tex files
+        folders: Relative paths of the project's folders
+    """
+    keep = set(manifest)
+    keep.add(MANIFEST_NAME)
+    for tex_path in tex_paths:
+        stem = os.path.splitext(tex_path)[0]
+        keep.update(stem + extension for extension in GENERATED_EXTENSIONS)
+    
+    for dir_path, _, file_names in os.walk(project_dir, topdown=False):
+        relative_dir = Path(dir_path).relative_to(project_dir).as_posix()
+        for file_name in file_names:
+            relative_path = file_name if relative_dir == '.' else f"{relative_dir}/{file_name}"
+            if relative_path in keep or (file_name.startswith('preamble-') and file_name.endswith('.fmt')):
+                continue
+            os.unlink(os.path.join(dir_path, file_name))
+        if relative_dir != '.' and relative_dir not in folders and not os.listdir(dir_path):
+            os.rmdir(dir_path)
+
+def materialize_file(file_path: Path, file_format: str, content: str, known_digest: Optional[str] = None) -> Tuple[str, bool]:
+    """
+    Write a project file unless it already holds the same content.
+    
+    Args:
+        file_path: Path of the file to write
+        file_format: Lowercased file format
+        content: File content; base64 encoded for binary formats
+        known_digest: Digest recorded for the file by a previous compile, if any
+        
+    Returns:
+        Tuple of (content digest, whether the file was written)
+        
+    Raises:
+        Exception: If the file could not be written; no partial file is left behind
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(file_format.encode('utf-8') + b'\0')
+    digest.update(as_bytes(content))
+    content_digest = digest.hexdigest()
+    
+    # Keep the file, and its mtime, when the content has not changed
+    if content_digest == known_digest and file_path.is_file():
+        return content_digest, False
+    
+    try:
+        # Handle binary files (encoded as base64) vs text files
+        if file_format in IMAGE_FORMATS:
+            # Binary files - assume content is base64 encoded
+            write_base64_file(file_path, content)
+        else:
+            # Text files - encode once and write the bytes directly
+            write_file_bytes(file_path, content.encode('utf-8'))
+    except Exception:
+        file_path.unlink(missing_ok=True)
+        raise
+    
+    return content_digest, True
+
+def write_file_bytes(file_path: Path, data: bytes) -> None:
+    """
+    Write bytes to a file with os.write, skipping the buffered file object.
+    
+    The data is already complete in memory, so a buffer would only add a copy;
+    usually a single write call suffices.
+    
+    Args:
+        file_path: Path of the file to write
+        data: File content
+    """
+    fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+def write_base64_file(file_path: Path, content: str) -> None:
+    """
+    Decode base64 content into a file in chunks, so the decoded data is never held in memory whole.
+    
+    Args:
+        file_path: Path of the file to write
+        content: Base64 encoded file content, possibly containing whitespace
+        
+    Raises:
+        binascii.Error: If the content is not valid base64
+    """
+    with open(file_path, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+        pending = ''
+        for start in range(0, len(content), BASE64_CHUNK_CHARS):
+            # Drop line breaks and decode whole 4-character groups, carrying the rest over
+            chunk = pending + ''.join(content[start:start + BASE64_CHUNK_CHARS].split())
+            aligned = len(chunk) - len(chunk) % 4
+            # a2b_base64 reads an ASCII str in place; b64decode would copy it to bytes first
+            f.write(binascii.a2b_base64(chunk[:aligned]))
+            pending = chunk[aligned:]
+        if pending:
+            f.write(binascii.a2b_base64(pending))
+
+def load_manifest(project_dir: Path) -> Dict[str, str]:
+    """
+    Load the digests of the files written to a working directory by the last compile.
+    
+    Args:
+        project_dir: Persistent project working directory
+        
+    Returns:
+        Dictionary mapping relative paths to content digests (empty if unavailable)
+    """
+    try:
+        with open(project_dir / MANIFEST_NAME, 'rb') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(manifest, dict):
+        return {}
+    # Never follow entries that point outside the project directory
+    return {path: digest for path, digest in manifest.items() if isinstance(digest, str) and is_safe_path(path)}
+
+def save_manifest(project_dir: Path, manifest: Dict[str, str]) -> None:
+    """
+    Record the digests of the files now in a working directory.
+    
+    Args:
+        project_dir: Persistent project working directory
+        manifest: Dictionary mapping relative paths to content digests
+    """
+    partial_manifest = project_dir / f"{MANIFEST_NAME}.tmp"
+    with open(partial_manifest, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(partial_manifest, project_dir / MANIFEST_NAME)
+
+def get_project_dir(project_id: str) -> Tuple[Path, asyncio.Lock]:
+    """
+    Get the persistent working directory of a project and the lock guarding it.
+    
+    Args:
+        project_id: Client supplied project ID
+        
+    Returns:
+        Tuple of (working directory path, lock to hold while using it)
+    """
+    # Hash the ID so clients cannot choose the path
+    project_key = hashlib.blake2b(project_id.encode('utf-8'), digest_size=16).hexdigest()
+    lock = PROJECT_LOCKS.get(project_key)
+    if lock is None:
+        lock = asyncio.Lock()
+        PROJECT_LOCKS[project_key] = lock
+    return WORK_ROOT / project_key, lock
+
+def is_project_busy(project_key: str) -> bool:
+    """
+    Check whether a request is using a project working directory right now.
+    
+    Args:
+        project_key: Name of the working directory under WORK_ROOT
+        
+    Returns:
+        True if the project's lock is held
+    """
+    lock = PROJECT_LOCKS.get(project_key)
+    return lock is not None and lock.locked()
+
+def find_main_tex_file(project: FlatProject, file_paths: Dict[str, Path], specified_main: Optional[str] = None) -> Optional[Tuple[Path, str]]:
+    """
+    Find the main .tex file in the project.
+    
+    Args:
+        project: The flattened project
+        file_paths: Dictionary of file ID to path mappings
+        specified_main: Optional specified main file name
+        
+    Returns:
+        Tuple of (path, content) for the main .tex file or None if not found
+    """
+    # Only the last file listed for a path is written (see create_project_structure),
+    # so that is the content to validate and compile
+    last_indices = {file_path: i for i, file_path in enumerate(project.paths)}
+    
+    first_index = None
+    best_rank, best_index = len(MAIN_FILE_NAMES), None
+    documentclass_index = None
+    
+    # Rank every written .tex file in a single pass
+    for i in project.tex_indices:
+        if project.ids[i] not in file_paths or last_indices[project.paths[i]] != i:
+            continue
+        if first_index is None:
+            first_index = i
+        
+        # A specified main file wins outright
+        name = project.names[i]
+        if specified_main and name == specified_main:
+            return project.paths[i], project.contents[i]
+        
+        # Look for common main file names
+        rank = MAIN_FILE_NAMES.get(name.lower(), best_rank)
+        if rank < best_rank:
+            best_rank, best_index = rank, i
+        
+        # Look for files with \documentclass, only needed while no common name was seen
+        if best_index is None and documentclass_index is None:
+            if project.contents[i].find('\\documentclass', 0, 1000) != -1:  # Check first 1000 chars in place
+                documentclass_index = i
+    
+    if first_index is None:
+        return None
+    
+    if specified_main:
+        logger.warning(f"Specified main file {specified_main} not found")
+    
+    # Prefer a common name, then \documentclass, then fall back to the first .tex file
+    for i in (best_index, documentclass_index, first_index):
+        if i is not None:
+            return project.paths[i], project.contents[i]
+
+def collect_project_sources(project: FlatProject, file_paths: Dict[str, Path], base_path: Path) -> List[Tuple[str, str, str]]:
+    """
+    Collect the sources that were written for a project.
+    
+    Args:
+        project: The flattened project
+        file_paths: Dictionary of file ID to path mappings
+        base_path: Project directory the paths are relative to
+        
+    Returns:
+        List of (relative path, format, content) tuples
+    """
+    return [
+        (project.paths[i].relative_to(base_path).as_posix(), project.formats[i], project.contents[i])
+        for i, file_id in enumerate(project.ids)
+        if file_id in file_paths
+    ]
+
+def compute_cache_key(sources: List[Tuple[Union[str, bytes], ...]], main_file: str, compiler: str, compiler_version: str) -> str:
+    """
+    Compute the cache key identifying a compilation.
+    
+    Args:
+        sources: Tuples describing every source file (path, content, ...)
+        main_file: Name of the main .tex file relative to the project root
+        compiler: LaTeX compiler that will be used
+        compiler_version: Version banner of the compiler, so upgrades miss the cache
+        
+    Returns:
+        Hex digest of the compilation inputs
+    """
+    key = hashlib.blake2b(digest_size=32)
+    for part in [compiler, compiler_version, main_file] + [part for source in sorted(sources) for part in source]:
+        data = as_bytes(part)
+        # Length-prefix each field so different splits never collide
+        key.update(len(data).to_bytes(8, 'little'))
+        key.update(data)
+    return key.hexdigest()
+
+def get_cached_pdf(key: str) -> Optional[Tuple[Path, str]]:
+    """
+    Look up a previously compiled PDF and its logs in the cache.
+    
+    Args:
+        key: Cache key from compute_cache_key
+        
+    Returns:
+        Tuple of (path to the cached PDF, compilation logs) or None on a cache miss
+    """
+    entry = CACHE_DIR / key
+    try:
+        logs = (entry / "logs.txt").read_text(encoding='utf-8')
+        # Refresh mtime so eviction drops the least recently used entries
+        os.utime(entry)
+    except OSError:
+        return None
+    return entry / "main.pdf", logs
+
+def store_cached_pdf(key: str, pdf_path: Path, logs: str) -> None:
+    """
+    Store a compiled PDF and its logs in the cache, evicting the oldest entries when full.
+    
+    The entry is assembled in a private directory and renamed into place, so
+    concurrent readers never see a partially written PDF.
+    
+    Args:
+        key: Cache key from compute_cache_key
+        pdf_path: Path to the freshly compiled PDF
+        logs: Logs of the compilation that produced the PDF
+    """
+    partial_entry = CACHE_DIR / f"{key}.{os.getpid()}.{id(pdf_path)}.tmp"
+    try:
+        partial_entry.mkdir(parents=True)
+        shutil.copyfile(pdf_path, partial_entry / "main.pdf")
+        (partial_entry / "logs.txt").write_text(logs, encoding='utf-8')
+        os.rename(partial_entry, CACHE_DIR / key)
+        # Entries are named by their 64-character key, which leaves formats/ and partial entries alone
+        evict_oldest(CACHE_DIR, '?' * 64, CACHE_MAX_ENTRIES)
+    except OSError as e:
+        # Another request may have stored the same key first
+        shutil.rmtree(partial_entry, ignore_errors=True)
+        if not (CACHE_DIR / key).is_dir():
+            logger.warning(f"Could not store PDF in cache: {e}")
+
+def entry_size(entry: Path) -> int:
+    """
+    Get the size of a cache entry, summing the files of a directory.
+    
+    Args:
+        entry: Cache entry (file or directory)
+        
+    Returns:
+        Size in bytes (0 if the entry vanished)
+    """
+    try:
+        if not entry.is_dir():
+            return entry.lstat().st_size
+        total = 0
+        for dir_path, _, file_names in os.walk(entry):
+            for file_name in file_names:
+                total += os.lstat(os.path.join(dir_path, file_name)).st_size
+        return total
+    except OSError:
+        return 0
+
+def evict_oldest(directory: Path, pattern: str, max_entries: int, in_use: Optional[Callable[[str], bool]] = None, max_bytes: Optional[int] = None) -> None:
+    """
+    Delete the least recently used cache entries beyond a size bound.
+    
+    Args:
+        directory: Cache directory to trim
+        pattern: Glob pattern selecting the cache entries (files or directories)
+        max_entries: Number of entries to keep
+        in_use: Called with an entry name right before deleting it; entries
+            for which it returns True are kept but still count towards the bounds
+        max_bytes: Total size of the entries to keep, or None for no bound
+    """
+    def entry_mtime(entry: Path) -> float:
+        try:
+            return entry.stat().st_mtime
+        except OSError:
+            return 0
+    
+    entries = list(directory.glob(pattern))
+    sizes = {entry: entry_size(entry) for entry in entries} if max_bytes is not None else {}
+    remaining_entries, remaining_bytes = len(entries), sum(sizes.values())
+    
+    def over_bounds() -> bool:
+        return remaining_entries > max_entries or (max_bytes is not None and remaining_bytes > max_bytes)
+    
+    if not over_bounds():
+        return
+    
+    entries.sort(key=entry_mtime)
+    for entry in entries:
+        if not over_bounds():
+            break
+        if in_use and in_use(entry.name):
+            continue
+        if entry.is_dir():
+            # Take the directory out of use in one step before deleting its contents
+            evicted = entry.with_name(f"{entry.name}.{os.getpid()}.{id(entry)}.evicted")
+            try:
+                os.rename(entry, evicted)
+            except OSError:
+                continue
+            shutil.rmtree(evicted, ignore_errors=True)
+        else:
+            entry.unlink(missing_ok=True)
+        remaining_entries -= 1
+        remaining_bytes -= sizes.get(entry, 0)
+
+def as_bytes(tex_source: Union[str, bytes]) -> bytes:
+    """
+    Get LaTeX source as UTF-8 bytes, passing bytes through without a copy.
+    
+    Args:
+        tex_source: The LaTeX source code as str or bytes
+        
+    Returns:
+        The source as bytes
+    """
+    return tex_source if isinstance(tex_source, bytes) else tex_source.encode('utf-8', 'surrogatepass')
+
+def source_digest(tex_source: bytes) -> bytes:
+    """
+    Compute a compact digest of LaTeX source for memoizing scans.
+    
+    Args:
+        tex_source: The LaTeX source code as bytes
+        
+    Returns:
+        16-byte BLAKE2b digest of the source
+    """
+    return hashlib.blake2b(tex_source, digest_size=16).digest()
+
+def remember_scan(cache: OrderedDict, key: bytes, result: Any) -> None:
+    """
+    Store a scan result, dropping the least recently used entry when full.
+    
+    Args:
+        cache: One of the module-level scan caches
+        key: Digest of the scanned source
+        result: Result to remember
+    """
+    cache[key] = result
+    if len(cache) > SCAN_CACHE_MAX_ENTRIES:
+        cache.popitem(last=False)
+
+def choose_compiler(tex_source: Union[str, bytes]) -> str:
+    """
+    Choose the appropriate LaTeX compiler based on the document content.
+    
+    Results are memoized by source digest, so recompiling unchanged
+    sources skips the scan.
+    
+    Args:
+        tex_source: The LaTeX source code as str or UTF-8 bytes
+        
+    Returns:
+        The compiler command name ('xelatex', 'lualatex', or 'pdflatex')
+    """
+    tex_source = as_bytes(tex_source)
+    key = source_digest(tex_source)
+    if key in COMPILER_SCAN_CACHE:
+        COMPILER_SCAN_CACHE.move_to_end(key)
+        return COMPILER_SCAN_CACHE[key]
+    
+    compiler = detect_compiler(tex_source)
+    remember_scan(COMPILER_SCAN_CACHE, key, compiler)
+    return compiler
+
+def detect_compiler(tex_source: bytes) -> str:
+    """
+    Scan LaTeX source for features that need a specific compiler.
+    
+    Args:
+        tex_source: The LaTeX source code as UTF-8 bytes
+        
+    Returns:
+        The compiler command name ('xelatex', 'lualatex', or 'pdflatex')
+    """
+    # Collect packages and font commands in a single scan
+    needs_lualatex = False
+    has_font_commands = False
+    for match in COMPILER_FEATURE_RE.finditer(tex_source):
+        # XeLaTeX-specific packages take precedence over everything else
+        if match.group('xelatex'):
+            return 'xelatex'
+        if match.group('lualatex'):
+            needs_lualatex = True
+        else:
+            has_font_commands = True
+    
+    # Check for LuaLaTeX-specific packages
+    if needs_lualatex:
+        return 'lualatex'
+    
+    # Check for non-ASCII characters (suggests need for Unicode support)
+    if not tex_source.isascii():
+        return 'xelatex'
+    
+    # Check for specific font commands
+    if has_font_commands:
+        return 'xelatex'
+    
+    # Default to pdflatex for standard documents
+    return 'pdflatex'
+
+def validate_tex_file(tex_source: Union[str, bytes]) -> None:
+    """
+    Basic validation of LaTeX source for security and sanity.
+    
+    Args:
+        tex_source: The LaTeX source code to validate, as str or UTF-8 bytes
+        
+    Raises:
+        HTTPException: If validation fails
+    """
+    # Check for potentially dangerous commands in a single pass
+    tex_source = as_bytes(tex_source)
+    key = source_digest(tex_source)
+    if key in VALIDATION_SCAN_CACHE:
+        VALIDATION_SCAN_CACHE.move_to_end(key)
+        dangerous_command = VALIDATION_SCAN_CACHE[key]
+    else:
+        match = DANGEROUS_COMMAND_RE.search(tex_source)
+        dangerous_command = match.group(0).decode() if match else None
+        remember_scan(VALIDATION_SCAN_CACHE, key, dangerous_command)
+    
+    if dangerous_command:
+        raise HTTPException(
+            status_code=400, 
+            detail=f"Potentially dangerous command detected: {dangerous_command}"
+        )
+
+def preprocess_tex_content(tex_source: AnyStr) -> AnyStr:
+    """
+    Preprocess LaTeX content to handle common issues and undefined commands.
+    
+    Args:
+        tex_source: The LaTeX source code to preprocess, as str or bytes
+        
+    Returns:
+        Preprocessed LaTeX source code of the same type
+    """
+    # Handle common undefined commands that are often used in journal templates
+    replacements = {
+        '\\keywords': '\\textbf{Keywords:}',  # Replace \keywords with \textbf{Keywords:}
+        '\\PACS': '\\textbf{PACS:}',         # Replace \PACS with \textbf{PACS:}
+        '\\MSC': '\\textbf{MSC:}',           # Replace \MSC with \textbf{MSC:}
+        '\\JEL': '\\textbf{JEL:}',           # Replace \JEL with \textbf{JEL:}
+        '\\affiliation': '\\textit{Affiliation:}',  # Replace \affiliation with \textit{Affiliation:}
+        '\\correspondingauthor': '\\textbf{Corresponding Author:}',  # Replace \correspondingauthor
+        '\\email': '\\textit{Email:}',       # Replace \email with \textit{Email:}
+        '\\orcid': '\\textit{ORCID:}',       # Replace \orcid with \textit{ORCID:}
+    }
+    
+    processed_source = tex_source
+    for old_cmd, new_cmd in replacements.items():
+        if isinstance(processed_source, bytes):
+            old_cmd, new_cmd = old_cmd.encode(), new_cmd.encode()
+        processed_source = processed_source.replace(old_cmd, new_cmd)
+    
+    return processed_source
+
+async def read_stream_tail(stream: asyncio.StreamReader, limit: Optional[int]) -> bytes:
+    """
+    Read a subprocess stream to the end, keeping only its last bytes.
+    
+    Args:
+        stream: Stream to drain
+        limit: Number of trailing bytes to keep, or None to keep everything
+        
+    Returns:
+        The (tail of the) stream's output
+    """
+    chunks: deque = deque()
+    size = 0
+    while True:
+        chunk = await stream.read(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size += len(chunk)
+        # Drop whole chunks that lie entirely before the tail
+        while limit is not None and size - len(chunks[0]) >= limit:
+            size -= len(chunks.popleft())
+    
+    output = b''.join(chunks)
+    return output[-limit:] if limit is not None else output
+
+async def run_command(args: List[str], cwd: Optional[Path] = None, timeout: float = 120, capture_output: bool = True, output_limit: Optional[int] = None) -> subprocess.CompletedProcess:
+    """
+    Run an external command without blocking the event loop.
+    
+    Args:
+        args: Command and arguments to execute
+        cwd: Working directory for the command (defaults to the current one)
+        timeout: Seconds to wait before killing the command
+        capture_output: Capture stdout/stderr; when False both are discarded
+        output_limit: Keep only this many trailing bytes of each captured stream
+        
+    Returns:
+        CompletedProcess with decoded stdout and stderr ("" when not captured)
+        
+    Raises:
+        subprocess.TimeoutExpired: If the command did not finish in time
+    """
+    output = asyncio.subprocess.PIPE if capture_output else asyncio.subprocess.DEVNULL
+    # A session of its own makes the command the leader of a process group,
+    # so killing the group also kills the compilers latexmk starts
+    proc = await asyncio.create_subprocess_exec(
+        *args,
+        cwd=cwd,
+        stdout=output,
+        stderr=output,
+        start_new_session=True
+    )
+    
+    async def kill_process_group() -> None:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await proc.wait()
+    
+    async def communicate() -> Tuple[bytes, bytes]:
+        if not capture_output:
+            await proc.wait()
+            return b'', b''
+        # Drain both pipes while bounding what is held in memory
+        stdout, stderr, _ = await asyncio.gather(
+            read_stream_tail(proc.stdout, output_limit),
+            read_stream_tail(proc.stderr, output_limit),
+            proc.wait()
+        )
+        return stdout, stderr
+    
+    try:
+        stdout, stderr = await asyncio.wait_for(communicate(), timeout=timeout)
+    except asyncio.TimeoutError:
+        await kill_process_group()
+        raise subprocess.TimeoutExpired(args, timeout)
+    except asyncio.CancelledError:
+        # Don't leave the compiler, or anything it started, running when the request is abandoned
+        await kill_process_group()
+        raise
+    
+    return subprocess.CompletedProcess(
+        args,
+        proc.returncode,
+        stdout.decode('utf-8', errors='replace') if stdout else "",
+        stderr.decode('utf-8', errors='replace') if stderr else ""
+    )
+
+def read_log_tail(log_path: Path, limit: Optional[int] = LOG_TAIL_BYTES) -> str:
+    """
+    Read the end of a LaTeX .log transcript, where errors are reported.
+    
+    Args:
+        log_path: Path to the .log file
+        limit: Number of trailing bytes to read, or None for the whole log
+        
+    Returns:
+        Up to limit bytes of the log, decoded leniently
+    """
+    try:
+        with open(log_path, 'rb') as f:
+            if limit is not None:
+                f.seek(max(0, os.fstat(f.fileno()).st_size - limit))
+            return f.read().decode('utf-8', errors='replace')
+    except OSError as e:
+        return f"Could not read {log_path.name}: {e}"
+
+def read_compiled_pdf(pdf_path: Path) -> bytes:
+    """
+    Read a freshly compiled PDF for the response.
+    
+    The PDF is read once and then only sent over the network, so the kernel
+    is told to drop its pages afterwards rather than letting them evict the
+    hot .aux/.log/.sty pages other compiles are using. The hint does nothing
+    on tmpfs; it matters when the scratch directory or LATEX_WORK_ROOT is on
+    disk. Cached PDFs are re-read on every hit and must not go through here.
+    
+    Args:
+        pdf_path: Path to the PDF file
+        
+    Returns:
+        Contents of the PDF
+    """
+    with open(pdf_path, 'rb') as pdf_file:
+        pdf_data = pdf_file.read()
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(pdf_file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    return pdf_data
+
+def format_log_section(log_path: Path, limit: Optional[int]) -> str:
     """
-    Check if a file path is safe (no directory traversal attacks).
+    Format the .log transcript of a failed run for the response logs.
     
     Args:
-        path: File path to validate
+        log_path: Path to the .log file
+        limit: Number of trailing bytes to include, or None for the whole log
         
     Returns:
-        True if path is safe, False otherwise
+        Labelled log text
     """
-    # Normalize the path
-    normalized = os.path.normpath(path)
-    
-    # Check for directory traversal attempts
-    if normalized.startswith('..') or '/../' in normalized or normalized.startswith('/'):
-        return False
-    
-    return True
+    label = "LOG" if limit is None else f"LOG (last {limit} bytes)"
+    return f"{label}:\n{read_log_tail(log_path, limit)}\n"
 
-def create_project_structure(folder_data: PaperFolderData, base_path: Path, current_path: Path = None) -> Dict[str, Path]:
+def auxiliary_digest(working_dir: Path, main_tex_name: str, extensions: Tuple[str, ...]) -> bytes:
     """
-    Recursively create the project folder structure and files.
+    Hash the auxiliary files a LaTeX pass leaves for the next one.
     
     Args:
-        folder_data: The folder data structure
-        base_path: Base directory path
-        current_path: Current directory path (for recursion)
+        working_dir: Directory containing the main .tex file
+        main_tex_name: Name of main tex file (without extension)
+        extensions: Extensions of the auxiliary files to hash
         
     Returns:
-        Dictionary mapping file IDs to their paths
+        16-byte BLAKE2b digest; missing files hash like empty ones
     """
-    if current_path is None:
-        current_path = base_path
-    
-    file_paths = {}
-    
-    # Create current folder if not root
-    if not folder_data.is_root:
-        folder_path = current_path / folder_data.name
-        folder_path.mkdir(exist_ok=True)
-        current_path = folder_path
-    
-    # Create files in current folder
-    if folder_data.files:
-        for file_info in folder_data.files:
-            if not is_safe_path(file_info.name):
-                logger.warning(f"Skipping unsafe file path: {file_info.name}")
-                continue
-            
-            file_path = current_path / file_info.name
-            
-            # Validate file extension
-            file_ext = Path(file_info.name).suffix.lower()
-            if file_ext and file_ext not in ALLOWED_EXTENSIONS:
-                logger.warning(f"Skipping file with unsupported extension: {file_info.name}")
-                continue
-            
-            try:
-                # Handle binary files (encoded as base64) vs text files
-                if file_info.format.lower() in ['png', 'jpg', 'jpeg', 'gif', 'pdf', 'eps']:
-                    # Binary files - assume content is base64 encoded
-                    import base64
-                    try:
-                        binary_content = base64.b64decode(file_info.content)
-                        with open(file_path, 'wb') as f:
-                            f.write(binary_content)
-                    except Exception as e:
-                        logger.error(f"Error writing binary file {file_info.name}: {e}")
-                        continue
-                else:
-                    # Text files
-                    with open(file_path, 'w', encoding='utf-8') as f:
-                        f.write(file_info.content)
-                
-                file_paths[file_info.id] = file_path
-                logger.info(f"Created file: {file_path}")
-                
-            except Exception as e:
-                logger.error(f"Error creating file {file_info.name}: {e}")
-                continue
+    digest = hashlib.blake2b(digest_size=16)
+    for extension in extensions:
+        try:
+            digest.update((working_dir / f"{main_tex_name}{extension}").read_bytes())
+        except OSError:
+            pass
+        digest.update(b'\0')
+    return digest.digest()
+
+def needs_rerun(log_path: Path) -> bool:
+    """
+    Check whether LaTeX asked for another pass to settle cross-references.
     
-    # Recursively create subfolders
-    if folder_data.subfolders:
-        for subfolder in folder_data.subfolders:
-            subfolder_paths = create_project_structure(subfolder, base_path, current_path)
-            file_paths.update(subfolder_paths)
+    Args:
+        log_path: Path to the .log file written by the last pass
+        
+    Returns:
+        True if the log contains a rerun request, False otherwise
+    """
+    try:
+        log_data = log_path.read_bytes()
+    except OSError:
+        return False
     
-    return file_paths
+    return any(log_data.find(marker) != -1 for marker in RERUN_MARKERS)
 
-def find_main_tex_file(folder_data: PaperFolderData, file_paths: Dict[str, Path], specified_main: Optional[str] = None) -> Optional[Path]:
+async def get_compiler_version(compiler: str) -> str:
     """
-    Find the main .tex file in the project.
+    Get the version banner of a compiler, probing it only once per process.
+    
+    Failed probes are not remembered, so a compiler that was slow to start
+    or installed later is probed again on the next call.
     
     Args:
-        folder_data: The project folder structure
-        file_paths: Dictionary of file ID to path mappings
-        specified_main: Optional specified main file name
+        compiler: LaTeX compiler command name
         
     Returns:
-        Path to the main .tex file or None if not found
+        First line of the compiler's --version output, or "" if unavailable
+    """
+    if compiler not in COMPILER_VERSIONS:
+        try:
+            proc = await run_command([compiler, '--version'], timeout=5)
+        except (subprocess.TimeoutExpired, FileNotFoundError):
+            return ""
+        version = proc.stdout.partition('\n')[0] if proc.returncode == 0 else ""
+        if not version:
+            return ""
+        COMPILER_VERSIONS[compiler] = version
+    return COMPILER_VERSIONS[compiler]
+
+def read_recorded_inputs(fls_path: Path, project_dir: Path, main_tex_path: Path) -> List[str]:
     """
-    tex_files = []
+    List the files a LaTeX run read, from the .fls file written by -recorder.
     
-    # Collect all .tex files recursively
-    def collect_tex_files(folder: PaperFolderData):
-        if folder.files:
-            for file_info in folder.files:
-                if file_info.format.lower() == 'tex':
-                    if file_info.id in file_paths:
-                        tex_files.append((file_info, file_paths[file_info.id]))
+    Args:
+        fls_path: Path to the .fls file
+        project_dir: Directory containing the project
+        main_tex_path: Path to the main .tex file, which is left out
         
-        if folder.subfolders:
-            for subfolder in folder.subfolders:
-                collect_tex_files(subfolder)
-    
-    collect_tex_files(folder_data)
+    Returns:
+        Sorted paths; project files relative to the main file's folder, other files absolute
+    """
+    working_dir = os.path.realpath(main_tex_path.parent)
+    project_root = os.path.realpath(project_dir) + os.sep
+    main_file = os.path.realpath(main_tex_path)
+    read_paths = set()
+    written_paths = set()
+    current_dir = working_dir
     
-    if not tex_files:
-        return None
+    with open(fls_path, 'r', encoding='utf-8', errors='surrogateescape') as f:
+        for line in f:
+            kind, _, recorded_path = line.rstrip('\n').partition(' ')
+            if kind == 'PWD':
+                current_dir = recorded_path
+            elif kind == 'INPUT':
+                read_paths.add(os.path.normpath(os.path.join(current_dir, recorded_path)))
+            elif kind == 'OUTPUT':
+                written_paths.add(os.path.normpath(os.path.join(current_dir, recorded_path)))
     
-    # If main file is specified, try to find it
-    if specified_main:
-        for file_info, file_path in tex_files:
-            if file_info.name == specified_main:
-                return file_path
-        logger.warning(f"Specified main file {specified_main} not found")
+    inputs = []
+    for full_path in read_paths:
+        if full_path in written_paths or full_path == main_file:
+            continue
+        if full_path.startswith(project_root):
+            inputs.append(os.path.relpath(full_path, working_dir))
+        else:
+            inputs.append(full_path)
+    return sorted(inputs)
+
+def compute_format_key(preamble_key: str, inputs: List[str], working_dir: Path, project_files: List[str]) -> str:
+    """
+    Hash a preamble together with the current state of the files its format build read.
     
-    # Look for common main file names
-    common_names = ['main.tex', 'document.tex', 'paper.tex', 'thesis.tex']
-    for common_name in common_names:
-        for file_info, file_path in tex_files:
-            if file_info.name.lower() == common_name.lower():
-                return file_path
+    Project files are hashed by content. Other files (the TeX distribution)
+    are hashed by their stat results, plus whether a project file of the same
+    name now exists, since TeX would pick that one up instead. The names of
+    all project files are included too, because a preamble may read a file
+    only once it exists (\\IfFileExists) and the build never saw it.
     
-    # Look for files with \documentclass
-    for file_info, file_path in tex_files:
+    Args:
+        preamble_key: Hash of the compiler version and the preamble text
+        inputs: Paths from read_recorded_inputs
+        working_dir: Folder of the main .tex file
+        project_files: Sorted relative paths of the project files
+        
+    Returns:
+        Format cache key
+    """
+    key = hashlib.blake2b(preamble_key.encode('utf-8'), digest_size=16)
+    for project_file in project_files:
+        key.update(project_file.encode('utf-8', errors='surrogateescape') + b'\0')
+    key.update(b'\0')
+    for input_path in inputs:
+        key.update(input_path.encode('utf-8', errors='surrogateescape') + b'\0')
         try:
-            if '\\documentclass' in file_info.content[:1000]:  # Check first 1000 chars
-                return file_path
-        except Exception:
-            continue
-    
-    # Fall back to first .tex file
-    return tex_files[0][1] if tex_files else None
+            if os.path.isabs(input_path):
+                stat = os.stat(input_path)
+                key.update(f"{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}".encode('utf-8'))
+                key.update(b'shadowed' if (working_dir / os.path.basename(input_path)).exists() else b'')
+            else:
+                key.update(hashlib.blake2b((working_dir / input_path).read_bytes(), digest_size=16).digest())
+        except OSError:
+            key.update(b'missing')
+        key.update(b'\0')
+    return key.hexdigest()
 
-def choose_compiler(tex_source: str) -> str:
+def lookup_format_key(preamble_key: str, working_dir: Path, project_files: List[str]) -> Optional[str]:
     """
-    Choose the appropriate LaTeX compiler based on the document content.
+    Compute the format key from the inputs recorded by an earlier build of the same preamble.
     
     Args:
-        tex_source: The LaTeX source code as a string
+        preamble_key: Hash of the compiler version and the preamble text
+        working_dir: Folder of the main .tex file
+        project_files: Sorted relative paths of the project files
         
     Returns:
-        The compiler command name ('xelatex', 'lualatex', or 'pdflatex')
+        Format cache key, or None if the preamble was never built
     """
-    # Check for XeLaTeX-specific packages
-    xelatex_packages = ['fontspec', 'xltxtra', 'xunicode', 'polyglossia']
-    if any(f'\\usepackage{{{pkg}}}' in tex_source for pkg in xelatex_packages):
-        return 'xelatex'
+    try:
+        with open(FORMAT_CACHE_DIR / f"{preamble_key}.inputs", 'rb') as f:
+            inputs = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(inputs, list) or not all(isinstance(input_path, str) for input_path in inputs):
+        return None
+    return compute_format_key(preamble_key, inputs, working_dir, project_files)
+
+def publish_format(preamble_key: str, format_key: str, built_format: Path, inputs: List[str]) -> None:
+    """
+    Store a built format and the inputs it was keyed on in the format cache.
     
-    # Check for LuaLaTeX-specific packages
-    lualatex_packages = ['luacode', 'luatextra', 'luamplib']
-    if any(f'\\usepackage{{{pkg}}}' in tex_source for pkg in lualatex_packages):
-        return 'lualatex'
+    Both files are published atomically so concurrent compiles never load a
+    partial file.
     
-    # Check for non-ASCII characters (suggests need for Unicode support)
-    if any(ord(c) > 127 for c in tex_source):
-        return 'xelatex'
+    Args:
+        preamble_key: Hash of the compiler version and the preamble text
+        format_key: Key from compute_format_key
+        built_format: Path to the freshly built format
+        inputs: Paths from read_recorded_inputs
+    """
+    FORMAT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    partial_format = FORMAT_CACHE_DIR / f"{format_key}.{os.getpid()}.tmp"
+    shutil.copyfile(built_format, partial_format)
+    os.replace(partial_format, FORMAT_CACHE_DIR / f"{format_key}.fmt")
     
-    # Check for specific font commands
-    if '\\setmainfont' in tex_source or '\\setsansfont' in tex_source or '\\setmonofont' in tex_source:
-        return 'xelatex'
+    partial_inputs = FORMAT_CACHE_DIR / f"{preamble_key}.{os.getpid()}.tmp"
+    with open(partial_inputs, 'w', encoding='utf-8', errors='surrogateescape') as f:
+        json.dump(inputs, f)
+    os.replace(partial_inputs, FORMAT_CACHE_DIR / f"{preamble_key}.inputs")
     
-    # Default to pdflatex for standard documents
-    return 'pdflatex'
+    evict_oldest(FORMAT_CACHE_DIR, '*.fmt', FORMAT_CACHE_MAX_ENTRIES)
+    evict_oldest(FORMAT_CACHE_DIR, '*.inputs', FORMAT_CACHE_MAX_ENTRIES)
 
-def validate_tex_file(tex_source: str) -> None:
+def record_format_failure(preamble_key: str) -> None:
     """
-    Basic validation of LaTeX source for security and sanity.
+    Remember that a preamble could not be dumped, so later compiles skip the build.
     
     Args:
-        tex_source: The LaTeX source code to validate
-        
-    Raises:
-        HTTPException: If validation fails
+        preamble_key: Hash of the compiler version and the preamble text
     """
-    # Check for potentially dangerous commands
-    dangerous_commands = [
-        '\\write18',  # Shell escape
-        '\\immediate\\write18',  # Shell escape
-        '\\input{|',  # Pipe input
-        '\\openin',   # File operations
-        '\\openout',  # File operations
-    ]
-    
-    for cmd in dangerous_commands:
-        if cmd in tex_source:
-            raise HTTPException(
-                status_code=400, 
-                detail=f"Potentially dangerous command detected: {cmd}"
-            )
+    FORMAT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    (FORMAT_CACHE_DIR / f"{preamble_key}.failed").touch()
+    evict_oldest(FORMAT_CACHE_DIR, '*.failed', FORMAT_CACHE_MAX_ENTRIES)
 
-def preprocess_tex_content(tex_source: str) -> str:
+async def prepare_preamble_format(project_dir: Path, main_tex_path: Path, tex_source: Union[str, bytes], compiler: str) -> tuple[List[str], str]:
     """
-    Preprocess LaTeX content to handle common issues and undefined commands.
+    Provide a precompiled format for the document preamble.
+    
+    The preamble is dumped once with mylatexformat, recording every file the
+    dump reads. Formats are cached by a hash of the preamble text, the
+    compiler version, the names of the project files and the current state
+    of those files, so a preamble that loads project files is rebuilt when
+    they change and never shares a format with a project whose files differ.
+    Preambles that fail to dump are remembered and not built again.
+    Compiling with the format skips everything before \\begin{document}.
     
     Args:
-        tex_source: The LaTeX source code to preprocess
+        project_dir: Directory containing the project
+        main_tex_path: Path to the main .tex file
+        tex_source: Source of the main .tex file as written to disk
+        compiler: LaTeX compiler being used
         
     Returns:
-        Preprocessed LaTeX source code
+        Tuple of (extra compiler arguments, log message)
     """
-    # Handle common undefined commands that are often used in journal templates
-    replacements = {
-        '\\keywords': '\\textbf{Keywords:}',  # Replace \keywords with \textbf{Keywords:}
-        '\\PACS': '\\textbf{PACS:}',         # Replace \PACS with \textbf{PACS:}
-        '\\MSC': '\\textbf{MSC:}',           # Replace \MSC with \textbf{MSC:}
-        '\\JEL': '\\textbf{JEL:}',           # Replace \JEL with \textbf{JEL:}
-        '\\affiliation': '\\textit{Affiliation:}',  # Replace \affiliation with \textit{Affiliation:}
-        '\\correspondingauthor': '\\textbf{Corresponding Author:}',  # Replace \correspondingauthor
-        '\\email': '\\textit{Email:}',       # Replace \email with \textit{Email:}
-        '\\orcid': '\\textit{ORCID:}',       # Replace \orcid with \textit{ORCID:}
-    }
+    if not PREAMBLE_FORMATS_ENABLED or compiler != 'pdflatex':
+        return [], "Not used for this compiler"
     
-    processed_source = tex_source
-    for old_cmd, new_cmd in replacements.items():
-        processed_source = processed_source.replace(old_cmd, new_cmd)
+    tex_source = as_bytes(tex_source)
+    preamble_end = PREAMBLE_END_RE.search(tex_source)
+    if not preamble_end or tex_source.startswith(b'%&'):
+        return [], "No \\begin{document} found"
+    preamble = tex_source[:preamble_end.end()]
+    if PREAMBLE_FORMAT_BLOCKERS_RE.search(preamble):
+        return [], "Preamble opens output files"
     
-    return processed_source
+    version = await get_compiler_version(compiler)
+    if not version:
+        return [], "Compiler version unavailable"
+    
+    key = hashlib.blake2b(digest_size=16)
+    key.update(version.encode('utf-8') + b'\0')
+    key.update(preamble)
+    preamble_key = key.hexdigest()
+    
+    working_dir = main_tex_path.parent
+    failure_marker = FORMAT_CACHE_DIR / f"{preamble_key}.failed"
+    
+    def use_format(format_key: str) -> str:
+        # Drop formats for older preambles left in a reused working directory
+        format_name = f"preamble-{format_key}"
+        for stale_format in working_dir.glob('preamble-*.fmt'):
+            if stale_format.name != f"{format_name}.fmt":
+                stale_format.unlink()
+        return f"-fmt={format_name}"
+    
+    try:
+        # Files written for this request; a single uploaded file has no manifest
+        project_files = sorted(await asyncio.to_thread(load_manifest, project_dir))
+        format_key = await asyncio.to_thread(lookup_format_key, preamble_key, working_dir, project_files)
+        if format_key:
+            cached_format = FORMAT_CACHE_DIR / f"{format_key}.fmt"
+            if cached_format.exists():
+                os.utime(cached_format)
+                local_format = working_dir / f"preamble-{format_key}.fmt"
+                if not local_format.exists():
+                    # May be a dangling link to an evicted cache entry
+                    local_format.unlink(missing_ok=True)
+                    local_format.symlink_to(cached_format)
+                return [use_format(format_key)], "Using cached preamble format"
+        
+        if failure_marker.exists():
+            os.utime(failure_marker)
+            return [], "Preamble could not be dumped by an earlier build"
+        
+        logger.info("Building preamble format")
+        build_name = f"preamble-build-{preamble_key}"
+        built_format = working_dir / f"{build_name}.fmt"
+        recorded_inputs = working_dir / f"{build_name}.fls"
+        try:
+            proc = await run_command(
+                [compiler, '-ini', '-recorder', '-interaction=batchmode', f'-jobname={build_name}',
+                 f'&{compiler}', 'mylatexformat.ltx', main_tex_path.name],
+                working_dir,
+                timeout=COMPILE_PASS_TIMEOUT
+            )
+            if proc.returncode != 0 or not built_format.exists():
+                await asyncio.to_thread(record_format_failure, preamble_key)
+                return [], f"Could not build preamble format (return code {proc.returncode})"
+            if not recorded_inputs.exists():
+                return [], "Could not record the files read by the preamble"
+            
+            inputs = await asyncio.to_thread(read_recorded_inputs, recorded_inputs, project_dir, main_tex_path)
+            format_key = await asyncio.to_thread(compute_format_key, preamble_key, inputs, working_dir, project_files)
+            await asyncio.to_thread(publish_format, preamble_key, format_key, built_format, inputs)
+            os.replace(built_format, working_dir / f"preamble-{format_key}.fmt")
+        finally:
+            for build_file in (built_format, recorded_inputs, working_dir / f"{build_name}.log"):
+                build_file.unlink(missing_ok=True)
+        return [use_format(format_key)], "Built preamble format"
+    except subprocess.TimeoutExpired as e:
+        # A preamble that cannot be dumped in time would stall every compile
+        logger.warning(f"Preamble format unavailable: {e}")
+        await asyncio.to_thread(record_format_failure, preamble_key)
+        return [], f"Preamble format unavailable: {e}"
+    except OSError as e:
+        logger.warning(f"Preamble format unavailable: {e}")
+        return [], f"Preamble format unavailable: {e}"
 
-def run_bibtex_if_needed(project_dir: Path, main_tex_name: str, compiler: str) -> tuple[bool, str]:
+async def run_bibtex_if_needed(project_dir: Path, main_tex_name: str, compiler: str, has_bib: bool, log_limit: Optional[int] = LOG_TAIL_BYTES) -> tuple[bool, str]:
     """
     Run bibtex/biber if bibliography files are present.
     
@@ -305,15 +1403,16 @@ def run_bibtex_if_needed(project_dir: Path, main_tex_name: str, compiler: str) -
         project_dir: Project directory
         main_tex_name: Name of main tex file (without extension)
         compiler: LaTeX compiler being used
+        has_bib: Whether any .bib file was written for the project
+        log_limit: Trailing bytes of each output stream kept, or None for all
         
     Returns:
         Tuple of (success: bool, logs: str)
     """
-    bib_logs = ""
+    bib_log_parts: List[str] = []
     
     # Check if there are .bib files
-    bib_files = list(project_dir.rglob('*.bib'))
-    if not bib_files:
+    if not has_bib:
         return False, "No .bib files found"
     
     # Check if .aux file exists and contains bibliography citations
@@ -322,10 +1421,15 @@ def run_bibtex_if_needed(project_dir: Path, main_tex_name: str, compiler: str) -
         return False, "No .aux file found"
     
     try:
-        with open(aux_file, 'r', encoding='utf-8', errors='ignore') as f:
-            aux_content = f.read()
-            if '\\bibdata' not in aux_content and '\\citation' not in aux_content:
-                return False, "No bibliography citations found in .aux file"
+        # Scan the mapped file in place instead of decoding it into a string
+        with open(aux_file, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                has_citations = False
+            else:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as aux_content:
+                    has_citations = aux_content.find(b'\\bibdata') != -1 or aux_content.find(b'\\citation') != -1
+        if not has_citations:
+            return False, "No bibliography citations found in .aux file"
     except Exception as e:
         return False, f"Error reading .aux file: {str(e)}"
     
@@ -333,94 +1437,160 @@ def run_bibtex_if_needed(project_dir: Path, main_tex_name: str, compiler: str) -
     for bib_processor in ['biber', 'bibtex']:
         try:
             logger.info(f"Running {bib_processor}")
-            proc = subprocess.run(
-                [bib_processor, main_tex_name],
-                cwd=project_dir,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                timeout=30
-            )
+            proc = await run_command([bib_processor, main_tex_name], project_dir, timeout=BIBLIOGRAPHY_TIMEOUT, output_limit=log_limit)
             
-            bib_logs += f"=== {bib_processor.upper()} ===\n"
-            bib_logs += f"Return code: {proc.returncode}\n"
-            bib_logs += f"STDOUT:\n{proc.stdout}\n"
-            bib_logs += f"STDERR:\n{proc.stderr}\n\n"
+            bib_log_parts.append(f"=== {bib_processor.upper()} ===\n")
+            bib_log_parts.append(f"Return code: {proc.returncode}\n")
+            bib_log_parts.append(f"STDOUT:\n{proc.stdout}\n")
+            bib_log_parts.append(f"STDERR:\n{proc.stderr}\n\n")
             
             if proc.returncode == 0:
                 logger.info(f"{bib_processor} completed successfully")
-                return True, bib_logs
+                return True, "".join(bib_log_parts)
         except (subprocess.TimeoutExpired, FileNotFoundError) as e:
-            bib_logs += f"Failed to run {bib_processor}: {str(e)}\n"
+            bib_log_parts.append(f"Failed to run {bib_processor}: {str(e)}\n")
             continue
     
     logger.warning("Could not run bibliography processor")
-    return False, bib_logs
+    return False, "".join(bib_log_parts)
 
-@app.post("/compile-single")
-async def compile_single_file(file: UploadFile = File(...)):
+def accepts_multipart(accept: Optional[str]) -> bool:
     """
-    Compile a single LaTeX file to PDF with detailed logs.
+    Check whether the client asked for the multipart response format.
+    
+    Args:
+        accept: Value of the Accept request header
+        
+    Returns:
+        True if multipart/mixed is acceptable to the client
+    """
+    return bool(accept) and 'multipart/mixed' in accept.lower()
+
+def multipart_pdf_response(result: Dict[str, Any], pdf_data: bytes) -> StreamingResponse:
+    """
+    Build a multipart/mixed response carrying the JSON result and the raw PDF.
+    
+    The first part is the usual JSON response without pdf_data, the second
+    the PDF bytes, so clients avoid decoding a hex string twice its size.
+    
+    Args:
+        result: Response fields describing the compilation
+        pdf_data: Compiled PDF
+        
+    Returns:
+        StreamingResponse with a JSON part followed by an application/pdf part
+    """
+    boundary = os.urandom(16).hex()
+    head = (
+        f"--{boundary}\r\nContent-Type: application/json\r\n\r\n"
+        f"{json.dumps(result)}\r\n"
+        f"--{boundary}\r\nContent-Type: application/pdf\r\nContent-Length: {len(pdf_data)}\r\n\r\n"
+    ).encode('utf-8')
+    tail = f"\r\n--{boundary}--\r\n".encode('ascii')
+    return StreamingResponse(
+        iter([head, pdf_data, tail]),
+        media_type=f"multipart/mixed; boundary={boundary}"
+    )
+
+def pdf_response(result: Dict[str, Any], pdf_data: bytes, accept: Optional[str], pdf_encoding: str) -> Union[Dict[str, Any], StreamingResponse]:
+    """
+    Attach a compiled PDF to a successful compilation response.
+    
+    Args:
+        result: Response fields describing the compilation
+        pdf_data: Compiled PDF
+        accept: Accept request header
+        pdf_encoding: "hex" for pdf_data or "base64" for pdf_data_b64 in JSON responses
+        
+    Returns:
+        Multipart response if the client accepts it, otherwise the JSON response fields
+    """
+    if accepts_multipart(accept):
+        return multipart_pdf_response(result, pdf_data)
+    if pdf_encoding == "base64":
+        # One C-level pass producing 4 chars per 3 bytes instead of 2 per byte
+        result["pdf_data_b64"] = binascii.b2a_base64(pdf_data, newline=False).decode('ascii')
+    else:
+        result["pdf_data"] = pdf_data.hex()
+    return result
+
+async def compile_single_upload(file: UploadFile, project_dir: Path, full_logs: bool = False) -> Tuple[Dict[str, Any], Optional[Path], bool]:
+    """
+    Compile an uploaded LaTeX file inside the given directory.
     
     Args:
         file: Uploaded .tex file
+        project_dir: Directory to compile in; must outlive any use of the PDF
+        full_logs: Return complete logs; bypasses the PDF cache, whose entries hold truncated logs
         
     Returns:
-        JSON response with compilation status, PDF data (hex if successful), and logs
+        Tuple of (response fields without PDF data, PDF path or None on failure,
+        whether the PDF came from the cache)
+        
+    Raises:
+        HTTPException: If the upload is invalid
     """
     # Validate file type
     if not file.filename.endswith('.tex'):
         raise HTTPException(status_code=400, detail="File must have .tex extension")
     
     try:
-        # Read and decode the file
+        # Read the file, keeping the source as bytes throughout
         tex_source = await file.read()
-        tex_str = tex_source.decode('utf-8', errors='ignore')
         
         # Preprocess the LaTeX content to handle common issues
-        tex_str = preprocess_tex_content(tex_str)
+        tex_source = preprocess_tex_content(tex_source)
         
         # Validate the LaTeX source
-        validate_tex_file(tex_str)
+        validate_tex_file(tex_source)
         
         # Choose appropriate compiler
-        compiler = choose_compiler(tex_str)
+        compiler = choose_compiler(tex_source)
         logger.info(f"Using compiler: {compiler}")
         
-        with tempfile.TemporaryDirectory() as tmpdir:
-            project_dir = Path(tmpdir)
-            tex_path = project_dir / "main.tex"
-            
-            # Write the LaTeX source to file
-            with open(tex_path, 'w', encoding='utf-8') as f:
-                f.write(tex_str)
-            
-            # Compile the document
-            success, logs = await compile_project(project_dir, tex_path, compiler)
-            
-            if not success:
-                return {
-                    "status": "error",
-                    "message": "LaTeX compilation failed",
-                    "error": "LaTeX compilation failed",
-                    "compiler": compiler,
-                    "logs": logs,
-                    "filename": file.filename
-                }
-            
-            # Read and return the PDF with logs
-            pdf_path = project_dir / "main.pdf"
-            with open(pdf_path, 'rb') as pdf_file:
-                pdf_data = pdf_file.read()
-            
+        # Serve identical sources straight from the cache
+        cache_key = compute_cache_key([("main.tex", tex_source)], "main.tex", compiler, await get_compiler_version(compiler))
+        cached = None if full_logs else get_cached_pdf(cache_key)
+        if cached:
+            logger.info(f"Serving cached PDF for {file.filename}")
+            cached_pdf, cached_logs = cached
             return {
                 "status": "success",
                 "message": "LaTeX compilation successful",
                 "compiler": compiler,
-                "pdf_data": pdf_data.hex(),
-                "logs": logs,
+                "logs": f"=== CACHE HIT ===\nReusing PDF compiled from identical sources\n\n{cached_logs}",
                 "filename": file.filename.replace('.tex', '.pdf')
-            }
+            }, cached_pdf, True
+        
+        tex_path = project_dir / "main.tex"
+        
+        # Write the LaTeX source to file
+        write_file_bytes(tex_path, tex_source)
+        
+        # Compile the document
+        success, logs = await compile_project(project_dir, tex_path, tex_source, compiler, False, full_logs)
+        
+        if not success:
+            return {
+                "status": "error",
+                "message": "LaTeX compilation failed",
+                "error": "LaTeX compilation failed",
+                "compiler": compiler,
+                "logs": logs,
+                "filename": file.filename
+            }, None, False
+        
+        pdf_path = project_dir / "main.pdf"
+        if not full_logs:
+            store_cached_pdf(cache_key, pdf_path, logs)
+        
+        return {
+            "status": "success",
+            "message": "LaTeX compilation successful",
+            "compiler": compiler,
+            "logs": logs,
+            "filename": file.filename.replace('.tex', '.pdf')
+        }, pdf_path, False
     
     except Exception as e:
         logger.error(f"Compilation error: {str(e)}")
@@ -432,48 +1602,95 @@ async def compile_single_file(file: UploadFile = File(...)):
             "error": f"Internal server error: {str(e)}",
             "logs": "",
             "filename": file.filename if file.filename else "unknown"
-        }
+        }, None, False
+
+@app.post("/compile-single")
+async def compile_single_file(file: UploadFile = File(...), accept: Optional[str] = Header(None), pdf_encoding: Literal["hex", "base64"] = "hex", full_logs: bool = False):
+    """
+    Compile a single LaTeX file to PDF with detailed logs.
+    
+    Args:
+        file: Uploaded .tex file
+        accept: Accept header; multipart/mixed returns the PDF as raw bytes
+        pdf_encoding: Encoding of the PDF in JSON responses ("base64" fills pdf_data_b64)
+        full_logs: Return complete tool output and .log transcripts instead of their tails
+        
+    Returns:
+        JSON response with compilation status, PDF data (hex if successful), and logs,
+        or a multipart response when requested and compilation succeeded
+    """
+    with tempfile.TemporaryDirectory(dir=SCRATCH_DIR) as tmpdir:
+        result, pdf_path, cache_hit = await compile_single_upload(file, Path(tmpdir), full_logs)
+        
+        # Read and return the PDF with logs
+        if pdf_path:
+            if cache_hit:
+                # Cached PDFs are read again on every hit, so keep their pages
+                with open(pdf_path, 'rb') as pdf_file:
+                    pdf_data = pdf_file.read()
+            else:
+                pdf_data = read_compiled_pdf(pdf_path)
+            return pdf_response(result, pdf_data, accept, pdf_encoding)
+        
+        return result
 
 @app.post("/compile-single-download")
 async def compile_single_file_download(file: UploadFile = File(...)):
     """
     Compile a single LaTeX file to PDF and return as file download.
     
+    The PDF is streamed from disk with sendfile; the working directory is
+    removed once the response has been sent.
+    
     Args:
         file: Uploaded .tex file
         
     Returns:
         PDF file as direct download
     """
-    # Get the detailed response
-    detailed_response = await compile_single_file(file)
+    tmpdir = tempfile.mkdtemp(dir=SCRATCH_DIR)
+    try:
+        result, pdf_path, _ = await compile_single_upload(file, Path(tmpdir))
+    except BaseException:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
     
-    if detailed_response["status"] == "success":
-        # Convert hex back to binary
-        pdf_data = bytes.fromhex(detailed_response["pdf_data"])
-        
-        return Response(
-            content=pdf_data,
-            media_type="application/pdf",
-            headers={
-                "Content-Disposition": f"attachment; filename={detailed_response['filename']}",
-                "X-Compilation-Logs": "See /compile-single for detailed logs"
-            }
-        )
-    else:
-        raise HTTPException(status_code=422, detail=detailed_response)
+    if not pdf_path:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise HTTPException(status_code=422, detail=result)
+    
+    return FileResponse(
+        pdf_path,
+        media_type="application/pdf",
+        filename=result['filename'],
+        headers={"X-Compilation-Logs": "See /compile-single for detailed logs"},
+        background=BackgroundTask(shutil.rmtree, tmpdir, ignore_errors=True)
+    )
 
-@app.post("/compile-project")
-async def compile_latex_project(request: CompileRequest):
+@app.post("/compile-project", openapi_extra={
+    "requestBody": {
+        "required": True,
+        "content": {"application/json": {"schema": {"$ref": "#/components/schemas/CompileRequest"}}}
+    }
+})
+async def compile_latex_project(http_request: Request, accept: Optional[str] = Header(None), pdf_encoding: Literal["hex", "base64"] = "hex", full_logs: bool = False):
     """
     Compile a LaTeX project from structured folder data to PDF.
     
     Args:
-        request: CompileRequest containing project_data and optional main_file
+        http_request: Request whose JSON body is a CompileRequest containing
+            project_data and optional main_file
+        accept: Accept header; multipart/mixed returns the PDF as raw bytes
+        pdf_encoding: Encoding of the PDF in JSON responses ("base64" fills pdf_data_b64)
+        full_logs: Return complete tool output and .log transcripts instead of their tails;
+            bypasses the PDF cache, whose entries hold truncated logs
         
     Returns:
-        JSON response with compilation status, PDF data (hex if successful), and logs
+        JSON response with compilation status, PDF data (hex if successful), and logs,
+        or a multipart response when requested and compilation succeeded
     """
+    request = parse_compile_request(await http_request.body())
+    
     # Log the incoming request structure for debugging
     logger.info(f"Received project compilation request for project: {request.project_data.name}")
     logger.info(f"Project data fields: {list(request.project_data.__dict__.keys())}")
@@ -483,30 +1700,41 @@ async def compile_latex_project(request: CompileRequest):
             logger.info(f"First file fields: {list(request.project_data.files[0].__dict__.keys())}")
     
     try:
-        with tempfile.TemporaryDirectory() as tmpdir:
-            project_dir = Path(tmpdir)
+        project_dir, project_lock = get_project_dir(request.project_data.id)
+        async with project_lock:
+            project_dir.mkdir(parents=True, exist_ok=True)
+            # Mark the directory as recently used before evicting others
+            os.utime(project_dir)
             
-            # Create project structure and files
+            # Create project structure and files, rewriting only what changed
             logger.info("Creating project structure")
-            file_paths = create_project_structure(request.project_data, project_dir)
+            project = flatten_project(request.project_data, project_dir)
+            manifest = load_manifest(project_dir)
+            file_paths = await create_project_structure(project, manifest)
+            save_manifest(project_dir, manifest)
+            
+            # Trim the other projects now that this one's size is known; never
+            # delete the directory of a project that is compiling right now
+            await asyncio.to_thread(
+                evict_oldest, WORK_ROOT, '?' * 32, WORK_ROOT_MAX_ENTRIES, is_project_busy, WORK_ROOT_MAX_BYTES
+            )
+            has_bib = any(project.ids[i] in file_paths for i in project.bib_indices)
             
             if not file_paths:
                 raise HTTPException(status_code=400, detail="No valid files found in project")
             
             # Find main .tex file
-            main_tex_path = find_main_tex_file(request.project_data, file_paths, request.main_file)
+            main_tex = find_main_tex_file(project, file_paths, request.main_file)
             
-            if not main_tex_path:
+            if not main_tex:
                 raise HTTPException(status_code=400, detail="No main .tex file found in project")
             
+            # Use the in-memory source of the main file to determine compiler
+            main_tex_path, main_source = main_tex
             logger.info(f"Using main file: {main_tex_path}")
             
-            # Read main tex file to determine compiler
-            with open(main_tex_path, 'r', encoding='utf-8', errors='ignore') as f:
-                tex_content = f.read()
-            
             # Preprocess the LaTeX content to handle common issues
-            tex_content = preprocess_tex_content(tex_content)
+            tex_content = preprocess_tex_content(main_source)
             
             # Validate the LaTeX source
             validate_tex_file(tex_content)
@@ -515,10 +1743,39 @@ async def compile_latex_project(request: CompileRequest):
             compiler = choose_compiler(tex_content)
             logger.info(f"Using compiler: {compiler} for project")
             
+            # Serve identical sources straight from the cache
+            cache_key = compute_cache_key(
+                collect_project_sources(project, file_paths, project_dir),
+                main_tex_path.relative_to(project_dir).as_posix(),
+                compiler,
+                await get_compiler_version(compiler)
+            )
+            cached = None if full_logs else get_cached_pdf(cache_key)
+            if cached:
+                logger.info("Serving cached PDF for project")
+                cached_pdf, cached_logs = cached
+                with open(cached_pdf, 'rb') as pdf_file:
+                    pdf_data = pdf_file.read()
+                
+                result = {
+                    "status": "success",
+                    "message": "LaTeX compilation successful",
+                    "compiler": compiler,
+                    "logs": f"=== CACHE HIT ===\nReusing PDF compiled from identical sources\n\n{cached_logs}",
+                    "main_file": main_tex_path.name,
+                    "project_name": request.project_data.name
+                }
+                return pdf_response(result, pdf_data, accept, pdf_encoding)
+            
+            # Never mistake the PDF of a previous compile for a fresh one
+            main_tex_path.with_suffix('.pdf').unlink(missing_ok=True)
+            
             # Compile the project
-            success, logs = await compile_project(project_dir, main_tex_path, compiler)
+            success, logs = await compile_project(project_dir, main_tex_path, main_source, compiler, has_bib, full_logs)
             
             if not success:
+                # Start the next compile cold rather than from possibly broken .aux files
+                await asyncio.to_thread(shutil.rmtree, project_dir, ignore_errors=True)
                 return {
                     "status": "error",
                     "message": "LaTeX project compilation failed",
@@ -544,19 +1801,20 @@ async def compile_latex_project(request: CompileRequest):
                     "project_name": request.project_data.name
                 }
             
-            with open(pdf_path, 'rb') as pdf_file:
-                pdf_data = pdf_file.read()
+            if not full_logs:
+                store_cached_pdf(cache_key, pdf_path, logs)
+            pdf_data = read_compiled_pdf(pdf_path)
             
             logger.info("LaTeX project compilation successful")
-            return {
+            result = {
                 "status": "success",
                 "message": "LaTeX compilation successful",
                 "compiler": compiler,
-                "pdf_data": pdf_data.hex(),
                 "logs": logs,
                 "main_file": main_tex_path.name,
                 "project_name": request.project_data.name
             }
+            return pdf_response(result, pdf_data, accept, pdf_encoding)
     
     except Exception as e:
         logger.error(f"Project compilation error: {str(e)}")
@@ -607,165 +1865,237 @@ async def debug_project_structure(request: Request):
             "error": str(e)
         }
 
-async def compile_project(project_dir: Path, main_tex_path: Path, compiler: str) -> tuple[bool, str]:
+async def run_latexmk(working_dir: Path, main_tex_path: Path, compiler: str, format_args: List[str], log_limit: Optional[int] = LOG_TAIL_BYTES) -> Tuple[int, str]:
+    """
+    Compile with latexmk, which runs only the passes and bibliography tools the document needs.
+    
+    Args:
+        working_dir: Directory containing the main .tex file
+        main_tex_path: Path to the main .tex file
+        compiler: LaTeX compiler to use
+        format_args: Extra compiler arguments from prepare_preamble_format
+        log_limit: Trailing bytes of output and .log kept, or None for all
+        
+    Returns:
+        Tuple of (return code, logs)
+        
+    Raises:
+        FileNotFoundError: If latexmk is not installed
+        subprocess.TimeoutExpired: If the compilation did not finish in time
+    """
+    # -norc (which must come first) keeps latexmk from running rc files found in the project;
+    # -f keeps going after errors like the manual passes do; the PDF check decides success
+    args = ['latexmk', '-norc', LATEXMK_ENGINE_FLAGS[compiler], '-f', '-silent', '-interaction=nonstopmode']
+    if format_args:
+        args.append(f"-{compiler}={compiler} {' '.join(format_args)} %O %S")
+    
+    logger.info(f"Running latexmk with {compiler}")
+    proc = await run_command(args + [main_tex_path.name], working_dir, timeout=LATEXMK_TIMEOUT, output_limit=log_limit)
+    
+    latexmk_logs = f"=== latexmk ({compiler}) ===\n"
+    latexmk_logs += f"Return code: {proc.returncode}\n"
+    output = (proc.stdout + proc.stderr).strip()
+    if output:
+        latexmk_logs += f"OUTPUT:\n{output}\n"
+    if proc.returncode != 0:
+        latexmk_logs += format_log_section(working_dir / f"{main_tex_path.stem}.log", log_limit)
+    latexmk_logs += "\n"
+    
+    return proc.returncode, latexmk_logs
+
+async def compile_project(project_dir: Path, main_tex_path: Path, tex_source: Union[str, bytes], compiler: str, has_bib: bool, full_logs: bool = False) -> tuple[bool, str]:
     """
     Compile a LaTeX project with proper handling of bibliography and multiple runs.
     
     Args:
         project_dir: Directory containing the project
         main_tex_path: Path to the main .tex file
+        tex_source: Source of the main .tex file as written to disk
         compiler: LaTeX compiler to use
+        has_bib: Whether any .bib file was written for the project
+        full_logs: Include complete tool output and .log transcripts instead of their tails
         
     Returns:
         Tuple of (success: bool, logs: str)
     """
     main_tex_name = main_tex_path.stem
     working_dir = main_tex_path.parent
-    all_logs = ""
+    log_parts: List[str] = []
     first_pass_logs = ""
+    log_limit = None if full_logs else LOG_TAIL_BYTES
     
     try:
-        # First compilation run
-        logger.info(f"Running first compilation pass with {compiler}")
-        logger.info(f"Working directory: {working_dir}")
-        logger.info(f"Main tex file: {main_tex_path.name}")
-        
-        proc = subprocess.run(
-            [compiler, "-interaction=nonstopmode", main_tex_path.name],
-            cwd=working_dir,
-            capture_output=True,
-            text=True,
-            timeout=120
-        )
+        # Reuse a precompiled preamble when possible
+        format_args, format_logs = await prepare_preamble_format(project_dir, main_tex_path, tex_source, compiler)
+        log_parts.append(f"=== Preamble Format ===\n{format_logs}\n\n")
+        
+        # latexmk tracks dependencies and runs only the passes that are needed
+        try:
+            returncode, latexmk_logs = await run_latexmk(working_dir, main_tex_path, compiler, format_args, log_limit)
+            log_parts.append(latexmk_logs)
+            use_manual_passes = False
+            if returncode != 0:
+                logger.warning(f"latexmk returned code {returncode}, but continuing to check for PDF generation")
+        except FileNotFoundError:
+            logger.info("latexmk not found, falling back to manual compilation passes")
+            use_manual_passes = True
+        
+        if use_manual_passes:
+            # Intermediate passes only update .aux/.toc/.bbl, so they can skip PDF output
+            base_args = [compiler] + format_args + ['-interaction=nonstopmode']
+            draft_args = base_args + [DRAFT_MODE_FLAGS[compiler]]
+        
+            # Compiler output is discarded; the .log transcript is read on failure instead
+            log_path = working_dir / f"{main_tex_name}.log"
+        
+            # First compilation run (draft when a bibliography pass will force another run)
+            first_pass_draft = has_bib
+            logger.info(f"Running first compilation pass with {compiler}")
+            logger.info(f"Working directory: {working_dir}")
+            logger.info(f"Main tex file: {main_tex_path.name}")
+        
+            listings_digest = auxiliary_digest(working_dir, main_tex_name, LISTING_EXTENSIONS)
+            proc = await run_command((draft_args if first_pass_draft else base_args) + [main_tex_path.name], working_dir, timeout=COMPILE_PASS_TIMEOUT, capture_output=False)
 
-        first_pass_logs = f"=== First Compilation Pass ({compiler}) ===\n"
-        first_pass_logs += f"Return code: {proc.returncode}\n"
-        first_pass_logs += f"STDOUT:\n{proc.stdout}\n"
-        first_pass_logs += f"STDERR:\n{proc.stderr}\n\n"
-        all_logs += first_pass_logs
-        
-        # Check if first pass failed critically
-        # Note: LaTeX can return non-zero exit codes even when PDF is generated successfully
-        # We'll check if PDF was actually generated later
-        if proc.returncode != 0:
-            logger.warning(f"First compilation pass returned code {proc.returncode}, but continuing to check for PDF generation")
-
-        # Run bibliography processor if needed
-        bib_run, bib_logs = run_bibtex_if_needed(working_dir, main_tex_name, compiler)
-        if bib_run:
-            all_logs += bib_logs
-        else:
-            all_logs += f"=== Bibliography Processing ===\n{bib_logs}\n"
+            first_pass_logs = f"=== First Compilation Pass ({compiler}{', draft' if first_pass_draft else ''}) ===\n"
+            first_pass_logs += f"Return code: {proc.returncode}\n"
+            if proc.returncode != 0:
+                first_pass_logs += format_log_section(log_path, log_limit)
+            first_pass_logs += "\n"
+            log_parts.append(first_pass_logs)
         
-        # Second compilation run (for cross-references and bibliography)
-        logger.info("Running second compilation pass")
-        proc = subprocess.run(
-            [
-                compiler,
-                '-interaction=nonstopmode',
-                main_tex_path.name
-            ],
-            cwd=working_dir,
-            capture_output=True,
-            text=True,
-            timeout=120
-        )
+            # Check if first pass failed critically
+            # Note: LaTeX can return non-zero exit codes even when PDF is generated successfully
+            # We'll check if PDF was actually generated later
+            if proc.returncode != 0:
+                logger.warning(f"First compilation pass returned code {proc.returncode}, but continuing to check for PDF generation")
+
+            # Run bibliography processor if needed
+            bbl_digest = auxiliary_digest(working_dir, main_tex_name, ('.bbl',))
+            bib_run, bib_logs = await run_bibtex_if_needed(working_dir, main_tex_name, compiler, has_bib, log_limit)
+            if bib_run:
+                log_parts.append(bib_logs)
+            else:
+                log_parts.append(f"=== Bibliography Processing ===\n{bib_logs}\n")
+            bbl_changed = bib_run and auxiliary_digest(working_dir, main_tex_name, ('.bbl',)) != bbl_digest
         
-        second_pass_logs = f"=== Second Compilation Pass ({compiler}) ===\n"
-        second_pass_logs += f"Return code: {proc.returncode}\n"
-        second_pass_logs += f"STDOUT:\n{proc.stdout}\n"
-        second_pass_logs += f"STDERR:\n{proc.stderr}\n\n"
-        all_logs += second_pass_logs
-        
-        if proc.returncode != 0:
-            logger.warning(f"Second compilation pass returned code {proc.returncode}, but continuing to check for PDF generation")
-        
-        # Third compilation run if bibliography was processed
-        if bib_run:
-            logger.info("Running third compilation pass (after bibliography)")
-            proc = subprocess.run(
-                [
-                    compiler,
-                    '-interaction=nonstopmode',
-                    main_tex_path.name
-                ],
-                cwd=working_dir,
-                capture_output=True,
-                text=True,
-                timeout=120
-            )
+            # Second compilation run (for cross-references and bibliography)
+            previous_listings_digest, listings_digest = listings_digest, auxiliary_digest(working_dir, main_tex_name, LISTING_EXTENSIONS)
+            if bbl_changed:
+                second_pass_reason = "Bibliography changed"
+            elif first_pass_draft:
+                second_pass_reason = "First pass did not write the PDF"
+            elif needs_rerun(log_path):
+                second_pass_reason = "Rerun requested by LaTeX"
+            elif listings_digest != previous_listings_digest:
+                second_pass_reason = "Table of contents or lists changed"
+            else:
+                second_pass_reason = None
             
-            third_pass_logs = f"=== Third Compilation Pass ({compiler}) ===\n"
-            third_pass_logs += f"Return code: {proc.returncode}\n"
-            third_pass_logs += f"STDOUT:\n{proc.stdout}\n"
-            third_pass_logs += f"STDERR:\n{proc.stderr}\n\n"
-            all_logs += third_pass_logs
+            second_pass_run = second_pass_reason is not None
+            if second_pass_run:
+                # A changed bibliography always needs another pass to settle its citations
+                second_pass_draft = bbl_changed
+                logger.info(f"Running second compilation pass: {second_pass_reason}")
+                proc = await run_command((draft_args if second_pass_draft else base_args) + [main_tex_path.name], working_dir, timeout=COMPILE_PASS_TIMEOUT, capture_output=False)
             
-            if proc.returncode != 0:
-                logger.warning("Third compilation pass failed, but continuing with existing PDF")
+                second_pass_logs = f"=== Second Compilation Pass ({compiler}{', draft' if second_pass_draft else ''}) ===\n"
+                second_pass_logs += f"Reason: {second_pass_reason}\n"
+                second_pass_logs += f"Return code: {proc.returncode}\n"
+                if proc.returncode != 0:
+                    second_pass_logs += format_log_section(log_path, log_limit)
+                second_pass_logs += "\n"
+                log_parts.append(second_pass_logs)
+            
+                if proc.returncode != 0:
+                    logger.warning(f"Second compilation pass returned code {proc.returncode}, but continuing to check for PDF generation")
+            else:
+                log_parts.append("=== Second Compilation Pass Skipped ===\nNo rerun requested by LaTeX and no auxiliary files changed\n\n")
+            
+            # Third compilation run if the second pass was a draft or references are still settling
+            third_pass_reason = None
+            if second_pass_run:
+                previous_listings_digest, listings_digest = listings_digest, auxiliary_digest(working_dir, main_tex_name, LISTING_EXTENSIONS)
+                if second_pass_draft:
+                    third_pass_reason = "Second pass did not write the PDF"
+                elif needs_rerun(log_path):
+                    third_pass_reason = "Rerun requested by LaTeX"
+                elif listings_digest != previous_listings_digest:
+                    third_pass_reason = "Table of contents or lists changed"
+                else:
+                    log_parts.append("=== Third Compilation Pass Skipped ===\nOutput converged after the second pass\n\n")
+            
+            if third_pass_reason:
+                logger.info(f"Running third compilation pass: {third_pass_reason}")
+                proc = await run_command(base_args + [main_tex_path.name], working_dir, timeout=COMPILE_PASS_TIMEOUT, capture_output=False)
+            
+                third_pass_logs = f"=== Third Compilation Pass ({compiler}) ===\n"
+                third_pass_logs += f"Reason: {third_pass_reason}\n"
+                third_pass_logs += f"Return code: {proc.returncode}\n"
+                if proc.returncode != 0:
+                    third_pass_logs += format_log_section(log_path, log_limit)
+                third_pass_logs += "\n"
+                log_parts.append(third_pass_logs)
+            
+                if proc.returncode != 0:
+                    logger.warning("Third compilation pass failed, but continuing with existing PDF")
         
         # Check if PDF was actually generated
         pdf_path = working_dir / f"{main_tex_name}.pdf"
         if not pdf_path.exists():
-            all_logs += "=== ERROR ===\nPDF file was not generated despite compilation attempts\n"
+            log_parts.append("=== ERROR ===\nPDF file was not generated despite compilation attempts\n")
             # Include first pass logs if PDF generation fails to provide full context
-            all_logs = first_pass_logs + all_logs
-            return False, all_logs
+            log_parts.insert(0, first_pass_logs)
+            return False, "".join(log_parts)
         
         # Check if PDF is valid (not empty)
         try:
             pdf_size = pdf_path.stat().st_size
             if pdf_size == 0:
-                all_logs += "=== ERROR ===\nPDF file was generated but is empty (0 bytes)\n"
-                return False, all_logs
-            all_logs += f"=== PDF GENERATED ===\nPDF file size: {pdf_size} bytes\n"
+                log_parts.append("=== ERROR ===\nPDF file was generated but is empty (0 bytes)\n")
+                return False, "".join(log_parts)
+            log_parts.append(f"=== PDF GENERATED ===\nPDF file size: {pdf_size} bytes\n")
         except Exception as e:
-            all_logs += f"=== ERROR ===\nCould not check PDF file: {str(e)}\n"
-            return False, all_logs
+            log_parts.append(f"=== ERROR ===\nCould not check PDF file: {str(e)}\n")
+            return False, "".join(log_parts)
             
-        all_logs += "=== COMPILATION SUCCESSFUL ===\n"
-        all_logs += f"PDF generated successfully: {pdf_path}\n"
-        all_logs += f"PDF file size: {pdf_path.stat().st_size} bytes\n"
+        log_parts.append("=== COMPILATION SUCCESSFUL ===\n")
+        log_parts.append(f"PDF generated successfully: {pdf_path}\n")
+        log_parts.append(f"PDF file size: {pdf_path.stat().st_size} bytes\n")
+        all_logs = "".join(log_parts)
         compile_project.last_logs = all_logs
         return True, all_logs
         
-    except subprocess.TimeoutExpired:
-        all_logs += f"=== TIMEOUT ERROR ===\nCompilation timed out after 120 seconds\n"
+    except subprocess.TimeoutExpired as e:
+        log_parts.append(f"=== TIMEOUT ERROR ===\nCompilation timed out after {e.timeout:g} seconds\n")
         # Include first pass logs for timeout to provide full context
-        all_logs = first_pass_logs + all_logs
-        return False, all_logs
+        log_parts.insert(0, first_pass_logs)
+        return False, "".join(log_parts)
     except Exception as e:
         logger.error(f"Compilation error: {str(e)}")
-        all_logs += f"=== UNEXPECTED ERROR ===\n{str(e)}\n"
+        log_parts.append(f"=== UNEXPECTED ERROR ===\n{str(e)}\n")
         # Include first pass logs for unexpected errors to provide full context
-        all_logs = first_pass_logs + all_logs
-        return False, all_logs
+        log_parts.insert(0, first_pass_logs)
+        return False, "".join(log_parts)
 
 @app.get("/")
 async def root():
     """Health check endpoint."""
     return {"message": "LaTeX compilation service is running"}
 
+@app.on_event("startup")
+async def probe_compilers():
+    """Probe the installed compilers, also warming the version cache used for cache keys."""
+    versions = await asyncio.gather(*(get_compiler_version(compiler) for compiler in SUPPORTED_COMPILERS))
+    AVAILABLE_COMPILERS[:] = [compiler for compiler, version in zip(SUPPORTED_COMPILERS, versions) if version]
+    logger.info(f"Available compilers: {AVAILABLE_COMPILERS}")
+
 @app.get("/compilers")
 async def list_compilers():
-    """List available LaTeX compilers."""
-    compilers = ['pdflatex', 'xelatex', 'lualatex']
-    available = []
-    
-    for compiler in compilers:
-        try:
-            proc = subprocess.run(
-                [compiler, '--version'],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                timeout=5
-            )
-            if proc.returncode == 0:
-                available.append(compiler)
-        except (subprocess.TimeoutExpired, FileNotFoundError):
-            pass
-    
-    return {"available_compilers": available}
+    """List available LaTeX compilers, probing again those not found so far."""
+    if len(AVAILABLE_COMPILERS) < len(SUPPORTED_COMPILERS):
+        await probe_compilers()
+    return {"available_compilers": AVAILABLE_COMPILERS}
 
 @app.get("/info")
 async def service_info():
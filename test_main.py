@@ -0,0 +1,21 @@
+from fastapi.testclient import TestClient
+
+import main
+
+
+def test_compile_project_validates_the_main_file_that_is_written(tmp_path, monkeypatch):
+    """Of two files sharing a path only the last is written, so it must be the one validated."""
+    monkeypatch.setattr(main, "WORK_ROOT", tmp_path)
+    client = TestClient(main.app)
+    files = [
+        {"id": "1", "name": "main.tex", "format": "tex",
+         "content": "\\documentclass{article}\\begin{document}Hello\\end{document}"},
+        {"id": "2", "name": "main.tex", "format": "tex",
+         "content": "\\documentclass{article}\\begin{document}\\immediate\\write18{id}\\end{document}"},
+    ]
+    response = client.post("/compile-project", json={
+        "project_data": {"id": "duplicate-main", "name": "P", "is_root": True, "files": files, "subfolders": []}
+    })
+    
+    assert response.status_code == 400
+    assert "write18" in response.json()["detail"]